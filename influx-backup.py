@@ -2,9 +2,20 @@
 """InfluxDB backup/restore script using HTTP API and line-protocol format.
 
 Requires python 3.6+
+
+Requirements:
+pip3 install requests
+
+Optional, for faster dumps:
+pip3 install orjson
+
+Optional, for faster gzip compression and decompression:
+pip3 install isal
 """
 
 import argparse
+import collections
+import concurrent.futures
 import datetime
 import functools
 import getpass
@@ -12,12 +23,38 @@ import gzip
 import json
 import os
 import sys
+import threading
 import time
+import zlib
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+try:
+    # orjson parses bytes directly and is much faster on the large chunked responses.
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    # ISA-L gzip is several times faster than zlib, but only has compression levels up to 3.
+    from isal import igzip, isal_zlib
+except ImportError:
+    igzip = None
 
 READ_CHUCK_SIZE = 10000
-WRITE_CHUNK_SIZE = 5000
+WRITE_CHUNK_SIZE = 10000
+WRITE_CHUNK_BYTES = 10 * 1024 * 1024
+FILE_READ_SIZE = 1 << 20
+# Kinds of columns in a query response.
+TIME, TAG, FIELD, STRING_FIELD, INTEGER_FIELD = range(5)
+FIELD_KINDS = {'string': STRING_FIELD, 'integer': INTEGER_FIELD}
+# Serializes output of the concurrent workers.
+PRINT_LOCK = threading.Lock()
+STREAM_READ_SIZE = 1 << 16
+# Measurements, fields and tags of the dumped database, reused by the next dump into the same directory with --dump-reuse-schema.
+SCHEMA_FILENAME = '_schema.json'
 
 
 def measurement2filename(m):
@@ -34,108 +71,401 @@ def identifier2lineprotocol(d):
 
 def query_influxdb(params):
     """Run query on influxdb."""
-    r = requests.get(URL+'/query', auth=AUTH, params=params)
+    r = SESSION.get(URL+'/query', params=params)
     if r.status_code != 200:
-        print(params)
-        print(r.status_code, r.text)
+        with PRINT_LOCK:
+            print(params)
+            print(r.status_code, r.text)
+
         sys.exit(-1)
 
-    data = json.loads(r.text)
+    data = json_loads(r.content)
     return data
 
 
 def filter_measurements(measurements):
     """Filter measurement list."""
     if IGNORE_MEASUREMENTS:
-        new_list = []
-        for m in measurements:
-            if m not in IGNORE_MEASUREMENTS:
-                new_list.append(m)
-
-        measurements = new_list
-
-    i = 0
-    for m in measurements:
-        if m == FROM_MEASUREMENT:
-            return measurements[i:]
+        measurements = [m for m in measurements if m not in IGNORE_MEASUREMENTS]
 
-        i += 1
-
-    # Return nothing if FROM_MEASUREMENT was given and not matched above.
     if FROM_MEASUREMENT:
-        return []
+        # Return nothing if FROM_MEASUREMENT was given and not matched.
+        if FROM_MEASUREMENT not in measurements:
+            return []
+
+        return measurements[measurements.index(FROM_MEASUREMENT):]
 
     return measurements
 
 
-def chunked_read(db, query):
-    """Chunked request to InfluxDB."""
-    r = requests.get(URL+'/query', auth=AUTH, stream=True,
-                     params={'q': query, 'db': db, 'epoch': 'ns', 'chunked': 'true', 'chunk_size': READ_CHUCK_SIZE})
+def chunked_query(db, query):
+    """Chunked request to InfluxDB, return the streamed response."""
+    r = SESSION.get(URL+'/query', stream=True,
+                    params={'q': query, 'db': db, 'epoch': DUMP_PRECISION, 'chunked': 'true', 'chunk_size': READ_CHUCK_SIZE})
     if r.status_code != 200:
-        print(r.status_code, r.text)
+        with PRINT_LOCK:
+            print(r.status_code, r.text)
+
         sys.exit(-1)
 
-    # r.iter_lines() is an iterator where 1 line contains 1 chunk of data coming from InfluxDB.
-    return r.iter_lines()
+    return r
+
+
+def chunked_read(db, query):
+    """Chunked request to InfluxDB, return an iterator over the chunks of data."""
+    return iter_chunks(chunked_query(db, query))
+
+
+def iter_chunks(r):
+    """Yield lines of a streamed response, 1 line contains 1 chunk of data coming from InfluxDB."""
+    line = bytearray()
+    for data in r.iter_content(chunk_size=STREAM_READ_SIZE):
+        # Chunks are much bigger than the reads, so look for newlines in the new data only.
+        start = 0
+        end = data.find(b'\n')
+        while end >= 0:
+            line += data[start:end]
+            if line:
+                yield line
+                line = bytearray()
+
+            start = end+1
+            end = data.find(b'\n', start)
+
+        line += data[start:]
+
+    if line:
+        yield line
 
 
-def format_rows(m, msfields, data):
-    """Parse response from InfluxDB and format rows to write into the backup file."""
-    rows = []
+def gzip_module(compresslevel=0):
+    """Return the fastest gzip implementation supporting the compression level."""
+    if igzip and compresslevel <= isal_zlib.ISAL_BEST_COMPRESSION:
+        return igzip
+
+    return gzip
+
+
+def column_kind(col, msfields):
+    """Return the kind of a column given the measurement fields, the column is known to be a field or a tag."""
+    if col == 'time':
+        return TIME
+
+    if col not in msfields:
+        return TAG
+
+    return FIELD_KINDS.get(msfields[col], FIELD)
+
+
+def invalid_row(m, timestamp, fields):
+    """Exit on a row without time or fields."""
+    with PRINT_LOCK:
+        print(f'No "time" column or 0 fields for "{m}": time {timestamp}, fields {fields}')
+
+    sys.exit(-1)
+
+
+@functools.lru_cache(maxsize=None)
+def make_formatter(m, msfields, columns):
+    """Compile a function formatting the values of a series with the given columns into line protocol.
+
+    The kind and escaped key of each column are resolved here, so the generated loop is straight-line code.
+    """
+    measurement = identifier2lineprotocol(m)
+    msfields = dict(msfields)
+    timestamp = '0'
+    caches = []
+    tags = []
+    fields = []
+    for i, col in enumerate(columns):
+        kind = column_kind(col, msfields)
+        key = identifier2lineprotocol(col)
+        if kind == TIME:
+            timestamp = f'c[{i}]'
+            continue
+
+        code = [f'        val = c[{i}]',
+                "        if val is not None and val != '':"]
+        if kind == TAG:
+            # Tag values repeat a lot, so each distinct one is escaped only once per chunk.
+            caches.append(f'    cache{i} = {{}}')
+            code += [f'            tag = cache{i}.get(val)',
+                     '            if tag is None:',
+                     f'                tag = {"," + key + "="!r} + (escape(val) if type(val) == str else str(val))',
+                     f'                cache{i}[val] = tag',
+                     '            tags += tag']
+            tags.append((key.encode(), code))
+            continue
+
+        if kind == STRING_FIELD:
+            # Add double-quotes only for strings.
+            code.append(f"""            fields.append({key + '="'!r} + val.replace('"', '\\\\"') + '"')""")
+        elif kind == INTEGER_FIELD:
+            code.append(f"            fields.append({key + '='!r} f'{{val}}i')")
+        else:
+            code.append(f"            fields.append({key + '='!r} f'{{val}}')")
+
+        fields += code
+
+    # InfluxDB ingests points faster with tags sorted by key in byte order, as its series keys are.
+    body = [line for _, code in sorted(tags) for line in code] + fields
+
+    # Format: agent_status,agent=foo\ bar,tenant=roman duration_in_old_status=1207920,new_status="offline",old_status="available" 1496310265009000000
+    source = '\n'.join([
+        'def format_values(values, rows):',
+        f'    measurement = {measurement!r}',
+        *caches,
+        '    for c in values:',
+        "        tags = ''",
+        '        fields = []',
+        *body,
+        f'        timestamp = {timestamp}',
+        '        if not timestamp or len(fields) == 0:',
+        f'            invalid_row({m!r}, timestamp, fields)',
+        '',
+        """        rows += f"{measurement}{tags} {','.join(fields)} {timestamp}\\n".encode()""",
+    ])
+    namespace = {'escape': identifier2lineprotocol, 'invalid_row': invalid_row}
+    exec(source, namespace)
+    return namespace['format_values']
+
+
+def keys_queries(db, m):
+    """Return the queries of the field keys and the tag keys of a measurement."""
+    if RETENTION:
+        source = f'"{db}"."{RETENTION}"."{m}"'
+    else:
+        source = f'"{m}"'
+
+    return [f'SHOW FIELD KEYS FROM {source}', f'SHOW TAG KEYS FROM {source}']
+
+
+def parse_keys(results):
+    """Return the fields and the tag keys of a measurement from the results of its keys_queries."""
+    # Empty measurement has no fields, and a measurement may have no tags.
+    fields = {}
+    if 'series' in results[0]:
+        fields = {x[0]: x[1] for x in results[0]['series'][0]['values']}
+
+    tags = []
+    if 'series' in results[1]:
+        tags = [x[0] for x in results[1]['series'][0]['values']]
+
+    return fields, tags
+
+
+def refresh_keys(db, m, msfields, known):
+    """Query the fields and tags of a measurement again and add them to those known."""
+    data = query_influxdb({'q': ';'.join(keys_queries(db, m)), 'db': db})
+    fields, tags = parse_keys(data['results'])
+    msfields.update(fields)
+    known.update(fields, tags)
+
+
+def format_rows(db, m, msfields, known, data):
+    """Parse response from InfluxDB and format rows to write into the backup file.
+
+    Return the encoded rows and their count.
+    """
+    rows = bytearray()
+    row_count = 0
     for a in data['results']:
         if 'series' not in a:
             break
 
         for b in a['series']:
-            for c in b['values']:
-                timestamp = 0
-                tags = []
-                fields = []
-                for i in range(len(b['columns'])):
-                    col = b['columns'][i]
-                    val = c[i]
-                    if val is None or val == '':
-                        continue
-
-                    if col == 'time':
-                        timestamp = val
-                    elif col in msfields.keys():
-                        # Add double-quotes only for strings.
-                        if msfields[col] == 'string':
-                            val = val.replace('"', '\\"')
-                            val = f'"{val}"'
-                        elif msfields[col] == 'integer':
-                            val = f'{val}i'
-
-                        fields.append(f'{identifier2lineprotocol(col)}={val}')
-                    else:
-                        if type(val) == str:
-                            val = identifier2lineprotocol(val)
-
-                        tags.append(f'{identifier2lineprotocol(col)}={val}')
-
-                if timestamp == 0 or len(fields) == 0:
-                    print(f'No "time" column or 0 fields for "{m}": time {timestamp}, fields {fields}')
+            # A column is written as a tag only if it is known to be one. Fields may have been added since the
+            # schema was queried, or saved by a previous dump.
+            if not known.issuperset(b['columns']):
+                refresh_keys(db, m, msfields, known)
+                unknown = set(b['columns']) - known
+                if unknown:
+                    with PRINT_LOCK:
+                        print(f'ERROR dumping {m}, columns are neither fields nor tags: {sorted(unknown)}')
+
                     sys.exit(-1)
 
-                # Format: agent_status,agent=foo\ bar,tenant=roman duration_in_old_status=1207920,new_status="offline",old_status="available" 1496310265009000000
-                if tags:
-                    rows.append(f"{identifier2lineprotocol(m)},{','.join(tags)} {','.join(fields)} {timestamp}\n")
-                else:
-                    rows.append(f"{identifier2lineprotocol(m)} {','.join(fields)} {timestamp}\n")
+            format_values = make_formatter(m, tuple(msfields.items()), tuple(b['columns']))
+            format_values(b['values'], rows)
+            row_count += len(b['values'])
+
+    return rows, row_count
+
+
+def write_rows(f, db, m, msfields, known, data):
+    """Parse a chunk of data from InfluxDB and write it into the backup file.
+
+    Return the number of rows and the error returned by InfluxDB if any.
+    """
+    data = json_loads(data)
+    rows, row_count = format_rows(db, m, msfields, known, data)
+    f.write(rows)
+    if row_count == 0 and 'error' in data['results'][0]:
+        # Possible error.
+        return 0, data['results'][0]['error']
+
+    return row_count, None
+
+
+def collect_rows(m, future):
+    """Wait for write_rows to finish and return the number of rows, exit on error."""
+    row_count, error = future.result()
+    if error:
+        with PRINT_LOCK:
+            print(f'ERROR dumping {m}', error)
+
+        sys.exit(-1)
+
+    return row_count
+
+
+def last_line(line, data):
+    """Return the last line of the data, continuing the line if the data has no newline."""
+    data = line + data
+    start = data.rfind(b'\n', 0, len(data.rstrip(b'\n'))) + 1
+    return data[start:]
+
+
+def dump_measurement_raw(stop, db, m, msfields, query):
+    """Dump a single measurement as returned by InfluxDB, i.e. newline-delimited JSON chunks, until the stop event is set."""
+    filename = f'{DIR}/{measurement2filename(m)}.json'
+    with open(f'{DIR}/{measurement2filename(m)}.meta.json', 'w') as f:
+        json.dump({'measurement': m, 'fields': msfields, 'query': query, 'epoch': DUMP_PRECISION}, f)
+
+    r = chunked_query(db, query)
+    decompressor = None
+    if GZIP:
+        filename += '.gz'
+        if r.headers.get('Content-Encoding') == 'gzip':
+            # Already compressed by InfluxDB, store as is.
+            f = open(filename, 'wb')
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        else:
+            r.raw.decode_content = True
+            f = gzip_module(GZIP_LEVEL).open(filename, 'wb', compresslevel=GZIP_LEVEL)
+    else:
+        r.raw.decode_content = True
+        f = open(filename, 'wb')
+
+    # An error in the middle of the data, e.g. max-select-point exceeded, comes as the last chunk of a 200 response.
+    line = b''
+    while True:
+        block = r.raw.read(FILE_READ_SIZE)
+        if not block:
+            break
+
+        if stop.is_set():
+            f.close()
+            r.close()
+            return
+
+        f.write(block)
+        if decompressor:
+            block = decompressor.decompress(block)
+
+        line = last_line(line, block)
+
+    f.close()
+    data = json_loads(line) if line.strip() else {'results': [{}]}
+    if 'error' in data['results'][0]:
+        with PRINT_LOCK:
+            print(f'ERROR dumping {m}', data['results'][0]['error'])
+
+        sys.exit(-1)
+
+    with PRINT_LOCK:
+        print(f'Dumping {m}... {os.path.getsize(filename)} bytes')
+
+
+def dump_measurement(stop, db, m, msfields, mstags, where):
+    """Dump a single measurement into its backup file, until the stop event is set."""
+    if RETENTION:
+        query = f'SELECT * FROM "{db}"."{RETENTION}"."{m}" {where}'
+    else:
+        query = f'SELECT * FROM "{m}" {where}'
+
+    if RAW:
+        try:
+            dump_measurement_raw(stop, db, m, msfields, query)
+        except BaseException:
+            # Stop the other measurements too.
+            stop.set()
+            raise
+
+        return
+
+    if GZIP:
+        f = gzip_module(GZIP_LEVEL).open(f'{DIR}/{measurement2filename(m)}.gz', 'wb', compresslevel=GZIP_LEVEL)
+    else:
+        f = open(f'{DIR}/{measurement2filename(m)}', 'wb')
+
+    # Chunks are parsed, formatted and written by another thread while the next ones are received.
+    # A single writer keeps them in order, at most 4 chunks wait in memory.
+    known = {'time', *msfields, *mstags}
+    line_count = 0
+    stopped = False
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as writer:
+        try:
+            for data in chunked_read(db, query):
+                if stop.is_set():
+                    stopped = True
+                    break
+
+                while len(pending) >= 4:
+                    line_count += collect_rows(m, pending.popleft())
+
+                pending.append(writer.submit(write_rows, f, db, m, msfields, known, data))
+
+            while pending:
+                line_count += collect_rows(m, pending.popleft())
+        except BaseException:
+            # Do not process the chunks left after an error, and stop the other measurements too.
+            stop.set()
+            for future in pending:
+                future.cancel()
+
+            raise
+
+    f.close()
+    if stopped:
+        return
+
+    with PRINT_LOCK:
+        print(f'Dumping {m}... {line_count}')
+
+
+def load_schema(db):
+    """Load measurements and fields saved by a previous dump of the database into the backup directory."""
+    filename = f'{DIR}/{SCHEMA_FILENAME}'
+    if not REUSE_SCHEMA or not os.path.exists(filename):
+        return {}
+
+    with open(filename) as f:
+        schema = json.load(f)
+
+    if schema['db'] != db or schema['retention'] != RETENTION:
+        return {}
 
-    return rows
+    print(f'Using measurements, fields and tags from {filename}, measurements added since are not dumped.')
+    return schema
 
 
 def dump(db, where):
     """Create a backup."""
+    schema = load_schema(db)
     measurements = MEASUREMENTS
     if not measurements:
-        data = query_influxdb({'q': 'SHOW MEASUREMENTS', 'db': db})
-        if 'series' in data['results'][0]:
-            measurements = [i[0] for i in data['results'][0]['series'][0]['values']]
-            measurements = filter_measurements(measurements)
+        measurements = schema.get('measurements')
+        if measurements is None:
+            data = query_influxdb({'q': 'SHOW MEASUREMENTS', 'db': db})
+            measurements = []
+            if 'series' in data['results'][0]:
+                measurements = [i[0] for i in data['results'][0]['series'][0]['values']]
+
+            schema['measurements'] = measurements
+
+        measurements = filter_measurements(measurements)
 
     if not measurements:
         print('Nothing to dump - empty database.')
@@ -145,23 +475,17 @@ def dump(db, where):
     print(measurements)
     print()
 
-    # Get measurement fields.
-    queries = []
-    for m in measurements:
-        if RETENTION:
-            queries.append(f'SHOW FIELD KEYS FROM "{db}"."{RETENTION}"."{m}"')
-        else:
-            queries.append(f'SHOW FIELD KEYS FROM "{m}"')
-
-    data = query_influxdb(params={'q': ';'.join(queries), 'db': db})
-    msfields = {}
-    for i in data['results']:
-        # Empty measurement has no fields.
-        if 'series' not in i:
-            continue
-
-        msfields[i['series'][0]['name']] = {x[0]: x[1] for x in i['series'][0]['values']}
-
+    # Get measurement fields and tags, only of those not saved before. Measurements saved as empty may have data now.
+    fields = schema.setdefault('fields', {})
+    tags = schema.setdefault('tags', {})
+    missing = [m for m in measurements if not fields.get(m) or m not in tags]
+    if missing:
+        queries = [q for m in missing for q in keys_queries(db, m)]
+        data = query_influxdb(params={'q': ';'.join(queries), 'db': db})
+        for i, m in enumerate(missing):
+            fields[m], tags[m] = parse_keys(data['results'][2*i:2*i+2])
+
+    msfields = {m: fields[m] for m in measurements if fields[m]}
     print('Measurement fields:')
     print(msfields)
     print()
@@ -169,72 +493,164 @@ def dump(db, where):
     if not os.path.exists(DIR):
         os.makedirs(DIR)
 
-    # Get series data.
-    for m in measurements:
-        if m not in msfields:
-            # Empty measurement.
-            print(f'Ignoring {m}... 0')
-            continue
+    schema['db'] = db
+    schema['retention'] = RETENTION
+    with open(f'{DIR}/{SCHEMA_FILENAME}', 'w') as f:
+        json.dump(schema, f)
 
-        print(f'Dumping {m}... ', end='')
-        if GZIP:
-            f = gzip.open(f'{DIR}/{measurement2filename(m)}.gz', 'wt')
-        else:
-            f = open(f'{DIR}/{measurement2filename(m)}', 'w')
+    # Get series data, several measurements at a time.
+    futures = []
+    stop = threading.Event()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        for m in measurements:
+            if m not in msfields:
+                # Empty measurement.
+                with PRINT_LOCK:
+                    print(f'Ignoring {m}... 0')
+                continue
 
-        if RETENTION:
-            query = f'SELECT * FROM "{db}"."{RETENTION}"."{m}" {where}'
-        else:
-            query = f'SELECT * FROM "{m}" {where}'
-
-        line_count = 0
-        for data in chunked_read(db, query):
-            data = json.loads(data)
-            rows = format_rows(m, msfields[m], data)
-            f.writelines(rows)
-            line_count += len(rows)
-            if len(rows) == 0 and 'error' in data['results'][0]:
-                # Possible error.
-                print('ERROR', data['results'][0]['error'])
-                sys.exit(-1)
-
-        print(line_count)
-        f.close()
+            futures.append(executor.submit(dump_measurement, stop, db, m, msfields[m], tags[m], where))
+
+        # Propagate errors from the workers as soon as one fails, including sys.exit().
+        try:
+            concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+            for future in futures:
+                future.result()
+        except BaseException:
+            # After an error or interrupt, the measurements not started are cancelled and the running ones stop
+            # at their next chunk.
+            stop.set()
+            for future in futures:
+                future.cancel()
+
+            raise
 
 
-def write_points(db, lines, chunk_delay, precision):
+def write_points(db, data, chunk_delay, precision):
     """Write points to InfluxDB."""
     if chunk_delay:
         time.sleep(float(chunk_delay))
 
-    data = ''.join(lines)
+    headers = {'Content-Type': 'text/plain; charset=utf-8'}
+    if WRITE_GZIP_LEVEL:
+        # Line-protocol compresses well, even the fastest gzip level shrinks it several times.
+        data = gzip_module(WRITE_GZIP_LEVEL).compress(data, compresslevel=WRITE_GZIP_LEVEL)
+        headers['Content-Encoding'] = 'gzip'
+
     params = {'db': db, 'precision': precision}
     if RETENTION:
         params['rp'] = RETENTION
 
-    last_error = ''
-    retries = 10
-    while retries > 0:
-        try:
-            r = requests.post(URL+'/write', auth=AUTH, params=params, data=data.encode('utf-8'))
-            if r.status_code == 204:
-                return
+    # Transient errors are retried by the session.
+    try:
+        r = SESSION.post(URL+'/write', params=params, headers=headers, data=data)
+    except requests.exceptions.RequestException as err:
+        with PRINT_LOCK:
+            print(err)
 
-            # InfluxDB is able to skip point beyond rp you write to
-            if 'points beyond retention policy' in r.text:
-                return
+        sys.exit(-1)
+
+    if r.status_code == 204:
+        return
 
-            last_error = f' {r.status_code} HTTP error, {r.text}'
-        except Exception:
-            last_error = sys.exc_info()[0]
+    # InfluxDB is able to skip point beyond rp you write to
+    if 'points beyond retention policy' in r.text:
+        return
 
-        retries -= 1
-        time.sleep(1)
+    with PRINT_LOCK:
+        print(f'{r.status_code} HTTP error, {r.text}')
 
-    print(last_error)
     sys.exit(-1)
 
 
+def chunk_length(lines):
+    """Return how many of the lines go into the next write request."""
+    n = min(len(lines), WRITE_CHUNK_SIZE)
+    # Walk the lines one by one only when the whole slice is over the size limit.
+    if WRITE_CHUNK_BYTES and sum(map(len, lines[:n])) + n > WRITE_CHUNK_BYTES:
+        size = 0
+        for i in range(n):
+            # Stop before the payload grows over the size limit, but write at least 1 line.
+            size += len(lines[i])+1
+            if size > WRITE_CHUNK_BYTES and i > 0:
+                return i
+
+    return n
+
+
+def read_chunks(f):
+    """Read a binary backup file in large blocks and yield write payloads with their number of lines."""
+    lines = []
+    tail = b''
+    while True:
+        block = f.read(FILE_READ_SIZE)
+        if block:
+            lines += (tail+block).split(b'\n')
+            # The last element is an incomplete line or empty.
+            tail = lines.pop()
+        elif tail:
+            lines.append(tail)
+
+        # Cut requests out of the list of lines rather than handling them one by one.
+        while len(lines) >= WRITE_CHUNK_SIZE or (not block and lines):
+            n = chunk_length(lines)
+            yield b'\n'.join(lines[:n]), n
+            del lines[:n]
+
+        if not block:
+            return
+
+
+def submit_points(executor, pending, db, data, chunk_delay, precision):
+    """Schedule a write of points, waiting while too many writes are in flight."""
+    while len(pending) >= 2*RESTORE_CONCURRENCY:
+        pending.popleft().result()
+
+    pending.append(executor.submit(write_points, db, data, chunk_delay, precision))
+
+
+def restore_measurement(writers, stop, db, m, chunk_delay, precision, measurement_delay):
+    """Restore a single measurement from its backup file after the delay, until the stop event is set."""
+    if measurement_delay and stop.wait(measurement_delay):
+        return
+
+    if GZIP:
+        # The gzip reader pulls the compressed data 8 KB at a time, so buffer the file under it.
+        raw = open(f'{DIR}/{measurement2filename(m)}.gz', 'rb', buffering=FILE_READ_SIZE)
+        f = gzip_module().open(raw, 'rb')
+    else:
+        raw = f = open(f'{DIR}/{measurement2filename(m)}', 'rb', buffering=0)
+
+    # Chunks are read here and written by the pool of writers, keeping at most 2 chunks per writer in memory.
+    line_count = 0
+    pending = collections.deque()
+    try:
+        for data, count in read_chunks(f):
+            if stop.is_set():
+                return
+
+            submit_points(writers, pending, db, data, chunk_delay, precision)
+            line_count += count
+
+        # Wait for the whole measurement to be written.
+        while pending:
+            pending.popleft().result()
+    except BaseException:
+        # Stop the other measurements too.
+        stop.set()
+        raise
+    finally:
+        # Do not write the chunks left after an error or stop.
+        for future in pending:
+            future.cancel()
+
+        f.close()
+        raw.close()
+
+    with PRINT_LOCK:
+        print(f'Loading {measurement2filename(m)}... {line_count}')
+
+
 def restore(db, chunk_delay, measurement_delay, precision, force):
     """Restore from a backup."""
     if not os.path.exists(DIR):
@@ -244,9 +660,9 @@ def restore(db, chunk_delay, measurement_delay, precision, force):
     measurements = MEASUREMENTS
     if not measurements:
         if GZIP:
-            files = [f[:-3] for f in os.listdir(DIR) if os.path.isfile(DIR+'/'+f) and f.endswith('.gz')]
+            files = [f.name[:-3] for f in os.scandir(DIR) if f.name.endswith('.gz') and f.is_file()]
         else:
-            files = [f for f in os.listdir(DIR) if os.path.isfile(DIR+'/'+f) and not f.endswith('.gz')]
+            files = [f.name for f in os.scandir(DIR) if not f.name.endswith('.gz') and f.name != SCHEMA_FILENAME and f.is_file()]
 
         files.sort()
         measurements = filter_measurements(files)
@@ -262,7 +678,7 @@ def restore(db, chunk_delay, measurement_delay, precision, force):
 
     # Sanity check of timestamp precision.
     if GZIP:
-        f = gzip.open(f'{DIR}/{measurement2filename(measurements[0])}.gz', 'rt')
+        f = gzip_module().open(f'{DIR}/{measurement2filename(measurements[0])}.gz', 'rt')
     else:
         f = open(f'{DIR}/{measurement2filename(measurements[0])}', 'r')
 
@@ -285,31 +701,30 @@ def restore(db, chunk_delay, measurement_delay, precision, force):
         sys.exit()
 
     print()
-    for m in measurements:
-        if m != measurements[0] and measurement_delay:
-            time.sleep(float(measurement_delay))
-
-        print(f'Loading {measurement2filename(m)}... ', end='')
-        lines = []
-        line_count = 0
-        if GZIP:
-            f = gzip.open(f'{DIR}/{measurement2filename(m)}.gz', 'rt')
-        else:
-            f = open(f'{DIR}/{measurement2filename(m)}', 'r')
-
-        for i in f:
-            if len(lines) == WRITE_CHUNK_SIZE:
-                write_points(db, lines, chunk_delay, precision)
-                lines = []
-                line_count += WRITE_CHUNK_SIZE
-
-            lines.append(i)
+    # Several measurements are read at a time, all feeding the same pool of writers. With a delay between
+    # measurements, they are restored one at a time so that InfluxDB gets a break after each one.
+    futures = []
+    stop = threading.Event()
+    concurrency = 1 if measurement_delay else CONCURRENCY
+    with concurrent.futures.ThreadPoolExecutor(max_workers=RESTORE_CONCURRENCY) as writers, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as readers:
+        try:
+            for m in measurements:
+                delay = float(measurement_delay) if measurement_delay and m != measurements[0] else 0
+                futures.append(readers.submit(restore_measurement, writers, stop, db, m, chunk_delay, precision, delay))
 
-        if lines:
-            write_points(db, lines, chunk_delay, precision)
+            # Propagate errors from the workers as soon as one fails, including sys.exit().
+            concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+            for future in futures:
+                future.result()
+        except BaseException:
+            # Stop writing into the database after an error or interrupt: the measurements not started are
+            # cancelled and the running ones stop at their next chunk.
+            stop.set()
+            for future in futures:
+                future.cancel()
 
-        print(line_count+len(lines))
-        f.close()
+            raise
 
 
 def validate_date(date_str):
@@ -341,16 +756,26 @@ if __name__ == '__main__':
     parser.add_argument('--from-measurement', help='dump/restore from this measurement and on (ignored when using --measurements)')
     parser.add_argument('--retention', help='retention to dump/restore')
     parser.add_argument('--gzip', action='store_true', help='dump/restore into/from gzipped files automatically')
+    parser.add_argument('--gzip-level', type=int, default=1, choices=range(1, 10), metavar='{1..9}', help='gzip compression level of dumped files, levels up to 3 use isal if installed. Default: 1, fastest')
     parser.add_argument('--dump', action='store_true', help='create a backup')
     parser.add_argument('--dump-db', help='database to dump')
     parser.add_argument('--dump-since', help='start date in the format YYYY-MM-DD (starting 00:00:00) or YYYY-MM-DDTHH:MM:SSZ')
     parser.add_argument('--dump-until', help='end date in the format YYYY-MM-DD (exclusive) or YYYY-MM-DDTHH:MM:SSZ')
+    parser.add_argument('--dump-raw', action='store_true', help='dump JSON responses of InfluxDB as is, with the fields of each measurement in a .meta.json file. Much faster, but cannot be restored with this script')
+    parser.add_argument('--dump-reuse-schema', action='store_true', help=f'use measurements, fields and tags saved in {SCHEMA_FILENAME} by a previous dump into the same directory instead of querying them, e.g. to resume a dump. Measurements added since are not dumped')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of measurements to dump/restore in parallel. Default: 4')
+    parser.add_argument('--dump-precision', help='timestamp precision of dumped points: ns,u,ms,s. Restore with the same --restore-precision. Default: ns', default='ns')
+    parser.add_argument('--dump-chunk-size', type=int, default=READ_CHUCK_SIZE, help='number of points per chunk read from InfluxDB, lower it to reduce memory usage. Default: %d' % READ_CHUCK_SIZE)
     parser.add_argument('--restore', action='store_true', help='restore from a backup')
     parser.add_argument('--force', action='store_true', help='restore without prompt')
     parser.add_argument('--restore-db', help='database target of restore')
     parser.add_argument('--restore-precision', help='restore precision: ns,u,ms,s,m,h. Default: ns', default='ns')
-    parser.add_argument('--restore-chunk-delay', help='restore delay in sec or subsec between chunks of %d points' % WRITE_CHUNK_SIZE)
-    parser.add_argument('--restore-measurement-delay', help='restore delay in sec or subsec between measurements')
+    parser.add_argument('--restore-batch-size', type=int, default=WRITE_CHUNK_SIZE, help='max number of points per write request. Default: %d' % WRITE_CHUNK_SIZE)
+    parser.add_argument('--restore-max-bytes', type=int, default=WRITE_CHUNK_BYTES, help='max size of a write request in bytes, before compression, 0 for no limit. Default: %d' % WRITE_CHUNK_BYTES)
+    parser.add_argument('--restore-gzip-level', type=int, default=1, choices=range(0, 10), metavar='{0..9}', help='gzip compression level of write requests, 0 to send them uncompressed. Default: 1')
+    parser.add_argument('--restore-chunk-delay', help='restore delay in sec or subsec between chunks of points')
+    parser.add_argument('--restore-concurrency', type=int, default=1, help='number of chunks of points to write in parallel. Default: 1')
+    parser.add_argument('--restore-measurement-delay', help='restore delay in sec or subsec between measurements, they are then restored one at a time regardless of --concurrency')
     args = parser.parse_args()
 
     if 'REQUESTS_CA_BUNDLE' not in os.environ:
@@ -362,9 +787,28 @@ if __name__ == '__main__':
         password = getpass.getpass()
 
     AUTH = (args.user, password)
+    CONCURRENCY = args.concurrency
+    RESTORE_CONCURRENCY = args.restore_concurrency
+    # One session for all requests: keep-alive connections, one per concurrent worker, and retries
+    # with capped exponential backoff on connection errors and on the 429/5xx InfluxDB returns when
+    # overloaded. A Retry-After header from the server takes precedence over the backoff.
+    SESSION = requests.Session()
+    SESSION.auth = AUTH
+    # Ask InfluxDB to gzip query responses, requests decompresses them transparently.
+    SESSION.headers['Accept-Encoding'] = 'gzip'
+    # The last response is returned once retries run out, so its status and error text are reported as before.
+    retry = Retry(total=10, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET', 'POST'],
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_maxsize=max(CONCURRENCY, RESTORE_CONCURRENCY), max_retries=retry)
+    SESSION.mount('http://', adapter)
+    SESSION.mount('https://', adapter)
     DIR = args.dir
     GZIP = args.gzip
+    GZIP_LEVEL = args.gzip_level
+    DUMP_PRECISION = args.dump_precision
+    RAW = args.dump_raw
     RETENTION = args.retention
+    REUSE_SCHEMA = args.dump_reuse_schema
     FROM_MEASUREMENT = args.from_measurement
     MEASUREMENTS = args.measurements
     if MEASUREMENTS:
@@ -372,17 +816,36 @@ if __name__ == '__main__':
 
     IGNORE_MEASUREMENTS = args.ignore_measurements
     if IGNORE_MEASUREMENTS:
-        IGNORE_MEASUREMENTS = IGNORE_MEASUREMENTS.split(',')
+        IGNORE_MEASUREMENTS = frozenset(IGNORE_MEASUREMENTS.split(','))
+
+    READ_CHUCK_SIZE = args.dump_chunk_size
+    WRITE_CHUNK_SIZE = args.restore_batch_size
+    WRITE_CHUNK_BYTES = args.restore_max_bytes
+    WRITE_GZIP_LEVEL = args.restore_gzip_level
 
     # Enable unbuffered output.
     print = functools.partial(print, flush=True)
 
+    for name in ['concurrency', 'dump_chunk_size', 'restore_batch_size', 'restore_concurrency']:
+        if getattr(args, name) < 1:
+            print(f"--{name.replace('_', '-')} should be at least 1")
+            sys.exit(-1)
+
+    if args.restore_max_bytes < 0:
+        print('--restore-max-bytes should be at least 0')
+        sys.exit(-1)
+
     if args.dump:
         if args.dump_db is None:
             print('--dump-db is required with --dump')
             parser.print_help()
             sys.exit(-1)
 
+        # line-protocol-to-clickhouse.py tells the precision from the number of digits, it cannot read m or h.
+        if args.dump_precision not in ['ns', 'u', 'ms', 's']:
+            print('--dump-precision should be one of ns,u,ms,s')
+            sys.exit(-1)
+
         WHERE = ''
         if args.dump_since and args.dump_until:
             validate_date(args.dump_since)
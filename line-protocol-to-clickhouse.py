@@ -7,42 +7,57 @@ Clickhouse password should be set via CH_PASSWORD env var if not blank.
 
 Requirements:
 pip3 install line-protocol-parser clickhouse-driver
+
+Optional, for faster decompression of gzipped backups:
+pip3 install isal
+
+Optional, for --compression:
+pip3 install clickhouse-driver[lz4] clickhouse-driver[zstd]
 """
 
 import argparse
+import collections
+import concurrent.futures
 import datetime
 import functools
-import gzip
+import itertools
+import multiprocessing
 import os
+import random
 import sys
+import time
 
 from clickhouse_driver import Client
+from clickhouse_driver.errors import ErrorCodes, NetworkError, ServerException, SocketTimeoutError
 from line_protocol_parser import LineFormatError, parse_line
 
-DEFAULT_INSERT_SIZE = 10**6
+try:
+    # ISA-L gzip is a drop-in replacement, faster than zlib.
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+DEFAULT_INSERT_SIZE = 50000
 INSERT_SETTINGS = {'max_partitions_per_insert_block': 5000}
+# Inserts failed on transient errors are retried with exponential backoff and full jitter, capped at INSERT_RETRY_MAX_DELAY seconds.
+INSERT_ATTEMPTS = 6
+INSERT_RETRY_DELAY = 0.2
+INSERT_RETRY_MAX_DELAY = 10
+# Saved by influx-backup.py next to the dumped measurements.
+SCHEMA_FILENAME = '_schema.json'
 
 
 def filter_measurements(measurements, from_measurement, ignore_measurements):
     """Filter the list of measurements."""
     if ignore_measurements:
-        new_list = []
-        for m in measurements:
-            if m not in ignore_measurements:
-                new_list.append(m)
-
-        measurements = new_list
-
-    i = 0
-    for m in measurements:
-        if m == from_measurement:
-            return measurements[i:]
+        measurements = [m for m in measurements if m not in ignore_measurements]
 
-        i += 1
-
-    # Return nothing if from_measurement was given and not matched above.
     if from_measurement:
-        return []
+        # Return nothing if from_measurement was given and not matched.
+        if from_measurement not in measurements:
+            return []
+
+        return measurements[measurements.index(from_measurement):]
 
     return measurements
 
@@ -57,13 +72,38 @@ def sanitize_column_name(i):
     return i.replace('-', '_')
 
 
-def write_records(client, columns, lines, args):
-    """Write records into clickhouse."""
+def table_insert(table_name, table_columns):
+    """Return the insert query of a table with the name, type and default value of each column.
+
+    The default is inserted when a row has no value for the column, it is None if there is no default for the type.
+    """
+    row_columns = '`,`'.join(table_columns.keys())
+    query = f'INSERT INTO `{table_name}` (`{row_columns}`) VALUES'
+    defaults = []
+    for k, v in table_columns.items():
+        v = v.lower()
+        if 'string' in v:
+            defaults.append((k, v, ''))
+        elif 'int' in v or 'float' in v:
+            defaults.append((k, v, 0))
+        else:
+            defaults.append((k, v, None))
+
+    return query, defaults
+
+
+def parse_records(tables, lines, args):
+    """Parse lines into records of each table."""
+    # Records of each table are collected by column, as (name, values, default) in the order of the table columns.
     records = {}
-    # Parse records.
+    time_scale = 10**args.time_precision
+    # Sanitized column name of each tag and field key, they repeat on every line.
+    names = {}
+    # Local name, looked up once per batch rather than once per line.
+    parse = parse_line
     for i in lines:
         try:
-            data = parse_line(i)
+            data = parse(i)
         except LineFormatError as err:
             print(f'LineFormatError: "{err}". Line: {i}')
             continue
@@ -73,57 +113,148 @@ def write_records(client, columns, lines, args):
         # len(time)==13 for ms
         # len(time)==16 for u
         # len(time)==19 for ns - influx default
-        row = {'time': int(data['time'] / 10**(len(str(data['time']))-10) * 10**args.time_precision)}
-        row.update(data['tags'])
+        t = data['time']
+        if t < 10**10:
+            values = {'time': t * time_scale}
+        elif t < 10**13:
+            values = {'time': t * time_scale // 10**3}
+        elif t < 10**16:
+            values = {'time': t * time_scale // 10**6}
+        else:
+            values = {'time': t * time_scale // 10**9}
+
+        # Sanitize column names. Fields are merged into the parsed tags rather than into a new dict.
+        row = data['tags']
         row.update(data['fields'])
-        # Sanitize column names
-        row = dict((sanitize_column_name(k), v) for k, v in row.items())
-        row_columns = ','.join(row.keys())
+        for k, v in row.items():
+            name = names.get(k)
+            if name is None:
+                name = names[k] = sanitize_column_name(k)
 
-        if table_name not in columns:
+            values[name] = v
+
+        if table_name not in tables:
             print(f'Skipping 1 row because {table_name} table does not exist.')
             continue
 
-        # Add missing columns.
-        for k, v in columns[table_name].items():
-            if k in row.keys():
-                continue
-
-            v = v.lower()
-            if 'string' in v:
-                row[k] = ''
-            elif 'int' in v or 'float' in v:
-                row[k] = 0
-            else:
-                print(f'Need to set default value for column "{k}" of type "{v}" in the script!')
+        if table_name not in records:
+            records[table_name] = [(k, [], default) for k, _, default in tables[table_name][1]]
+
+        # Fill every column of the table, with its default when the row has no value for it.
+        for k, column, default in records[table_name]:
+            v = values.get(k, default)
+            if v is None:
+                types = {k: v for k, v, _ in tables[table_name][1]}
+                print(f'Need to set default value for column "{k}" of type "{types[k]}" in the script!')
                 sys.exit(-1)
 
-        if table_name not in records:
-            records[table_name] = []
+            column.append(v)
+
+    return records
 
-        records[table_name].append(row)
 
-    # Write records.
-    for table_name, rows in records.items():
-        row_columns = '`,`'.join(columns[table_name].keys())
-        query = f'INSERT INTO `{table_name}` (`{row_columns}`) VALUES'
+def execute_insert(client, query, rows):
+    """Execute an insert of columnar rows, retrying on network errors and on too many parts on the server.
+
+    clickhouse-driver often reports a dropped connection as a bare EOFError.
+    Parallel workers retry after random delays, so they do not hit a busy server again all at once.
+    """
+    for attempt in range(1, INSERT_ATTEMPTS + 1):
         try:
-            client.execute(query, rows, settings=INSERT_SETTINGS)
-        except KeyError as err:
-            print(f'KeyError: {err}. Skipping batch of {len(rows)} points.')
-            continue
-        except BaseException as err:
+            return client.execute(query, rows, columnar=True, settings=INSERT_SETTINGS)
+        except (NetworkError, SocketTimeoutError, OSError, EOFError, ServerException) as err:
+            if isinstance(err, ServerException) and err.code != ErrorCodes.TOO_MANY_PARTS:
+                raise
+
+            if attempt == INSERT_ATTEMPTS:
+                raise
+
+            delay = random.uniform(0, min(INSERT_RETRY_MAX_DELAY, INSERT_RETRY_DELAY * 2**attempt))
             print(err)
-            print('Retrying...')
-            client.execute(query, rows, settings=INSERT_SETTINGS)
+            print(f'Retrying in {delay:.1f}s...')
+            time.sleep(delay)
+
+
+def write_records(client, tables, records):
+    """Write records into clickhouse."""
+    for table_name, table in records.items():
+        query = tables[table_name][0]
+        rows = [column for _, column, _ in table]
+        execute_insert(client, query, rows)
+        print(f'  {table_name}:{len(rows[0])}')
+
+
+def connect(args):
+    """Connect to clickhouse."""
+    password = os.environ.get('CH_PASSWORD', '')
+    compression = args.compression if args.compression != 'none' else False
+    return Client(host=args.host, port=args.port, secure=args.secure, user=args.user, password=password, database=args.db,
+                  compression=compression)
+
+
+def read_lines(f, count):
+    """Read up to count lines from a file."""
+    return list(itertools.islice(f, count))
+
+
+def restore_measurement(args, tables, stop, m):
+    """Restore a single measurement from its backup file, until the stop event is set."""
+    client = connect(args)
+    print(f'Loading {m}... ')
+    if args.mixed_files:
+        print()
+
+    if args.gzip:
+        f = gzip.open(f'{args.dir}/{m}.gz', 'rt')
+    else:
+        f = open(f'{args.dir}/{m}', 'r')
+
+    # Three stages on their own threads: the next lines are read and decompressed while the current ones
+    # are parsed, and the previous records are inserted. At most 2 batches of records wait for insertion.
+    line_count = 0
+    stopped = False
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as reader, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) as writer:
+        try:
+            future = reader.submit(read_lines, f, args.insert_size)
+            while True:
+                lines = future.result()
+                if not lines:
+                    break
+
+                if stop.is_set():
+                    stopped = True
+                    break
+
+                future = reader.submit(read_lines, f, args.insert_size)
+                records = parse_records(tables, lines, args)
+                line_count += len(lines)
+                while len(pending) >= 2:
+                    pending.popleft().result()
+
+                pending.append(writer.submit(write_records, client, tables, records))
+
+            # Wait for the whole measurement to be written.
+            while pending:
+                pending.popleft().result()
+        except BaseException:
+            # Do not insert the batches left after an error, and stop the other measurements too.
+            stop.set()
+            for future in pending:
+                future.cancel()
 
-        print(f'  {table_name}:{len(rows)}')
+            raise
+
+    f.close()
+    client.disconnect()
+    if not stopped:
+        print(f'- Total {m}:', line_count)
 
 
 def restore(args):
     """Restore from a backup."""
-    password = os.environ.get('CH_PASSWORD', '')
-    client = Client(host=args.host, port=args.port, secure=args.secure, user=args.user, password=password, database=args.db)
+    client = connect(args)
 
     if not os.path.exists(args.dir):
         print(f'Backup dir "{args.dir}" does not exist')
@@ -135,13 +266,13 @@ def restore(args):
 
     ignore_measurements = args.ignore_measurements
     if ignore_measurements:
-        ignore_measurements = ignore_measurements.split(',')
+        ignore_measurements = frozenset(ignore_measurements.split(','))
 
     if not measurements:
         if args.gzip:
-            files = [f[:-3] for f in os.listdir(args.dir) if os.path.isfile(args.dir+'/'+f) and f.endswith('.gz')]
+            files = [f.name[:-3] for f in os.scandir(args.dir) if f.name.endswith('.gz') and f.is_file()]
         else:
-            files = [f for f in os.listdir(args.dir) if os.path.isfile(args.dir+'/'+f) and not f.endswith('.gz')]
+            files = [f.name for f in os.scandir(args.dir) if not f.name.endswith('.gz') and f.name != SCHEMA_FILENAME and f.is_file()]
 
         files.sort()
         measurements = filter_measurements(files, args.from_measurement, ignore_measurements)
@@ -167,36 +298,37 @@ def restore(args):
 
         columns[x[0]][x[1]] = x[2]
 
-    # Iterate over files.
-    for m in measurements:
-        print(f'Loading {m}... ')
-        if args.mixed_files:
-            print()
-
-        if not args.mixed_files and m not in columns:
-            print('Skipping because the corresponding table does not exist.')
-            continue
+    # Insert query and column defaults of each table, the same for every batch.
+    tables = {k: table_insert(k, v) for k, v in columns.items()}
 
-        lines = []
-        line_count = 0
-        if args.gzip:
-            f = gzip.open(f'{args.dir}/{m}.gz', 'rt')
-        else:
-            f = open(f'{args.dir}/{m}', 'r')
-
-        for i in f:
-            if len(lines) == args.insert_size:
-                write_records(client, columns, lines, args)
-                lines = []
-                line_count += args.insert_size
+    client.disconnect()
+    # Parsing is CPU-bound, so several measurements are restored at a time in separate processes.
+    futures = []
+    with multiprocessing.Manager() as manager, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=args.concurrency) as executor:
+        # Shared by the worker processes to stop at their next batch when one of them fails.
+        stop = manager.Event()
+        for m in measurements:
+            if not args.mixed_files and m not in tables:
+                print(f'Loading {m}... ')
+                print('Skipping because the corresponding table does not exist.')
+                continue
 
-            lines.append(i)
+            futures.append(executor.submit(restore_measurement, args, tables, stop, m))
 
-        if lines:
-            write_records(client, columns, lines, args)
+        # Propagate errors from the workers as soon as one fails, including sys.exit().
+        try:
+            concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+            for future in futures:
+                future.result()
+        except BaseException:
+            # After an error or interrupt, the measurements not started are cancelled and the running ones stop
+            # at their next batch.
+            stop.set()
+            for future in futures:
+                future.cancel()
 
-        print('- Total:', line_count+len(lines))
-        f.close()
+            raise
 
 
 if __name__ == '__main__':
@@ -204,6 +336,7 @@ if __name__ == '__main__':
     parser.add_argument('--host', help='Clickhouse host', default='localhost')
     parser.add_argument('--port', help='Clickhouse port', default=9000)
     parser.add_argument('--secure', help='Clickhouse secure connection', action='store_true')
+    parser.add_argument('--compression', choices=['none', 'lz4', 'zstd'], default='none', help='compression of data sent to Clickhouse, needs the corresponding extra of clickhouse-driver. Default: none')
     parser.add_argument('--user', help='Clickhouse user. The password should be set via CH_PASSWORD env var if not blank.', default='default')
     parser.add_argument('--dir', required=True, help='directory with the backup to restore form')
     parser.add_argument('--db', required=True, help='Clickhouse database to restore into')
@@ -211,12 +344,18 @@ if __name__ == '__main__':
     parser.add_argument('--ignore-measurements', help='comma-separated list of measurements to skip from restore (ignored when using --measurements)')
     parser.add_argument('--from-measurement', help='restore starting from this measurement and on (ignored when using --measurements)')
     parser.add_argument('--gzip', action='store_true', help='restore from gzipped files')
-    parser.add_argument('--insert-size', help='number of records to insert with a single statement', default=DEFAULT_INSERT_SIZE)
-    parser.add_argument('--time-precision', help='time precision to store, corresponds to the type of "time" column. Default 3, i.e. ms', default=3)
+    parser.add_argument('--insert-size', type=int, help='number of records to insert with a single statement. Default: %d' % DEFAULT_INSERT_SIZE, default=DEFAULT_INSERT_SIZE)
+    parser.add_argument('--time-precision', type=int, help='time precision to store, corresponds to the type of "time" column. Default 3, i.e. ms', default=3)
+    parser.add_argument('--concurrency', type=int, default=1, help='number of measurements to restore in parallel, each in its own process. Default: 1')
     parser.add_argument('--mixed-files', action='store_true', help='backup files contain mixed measurements, file names are not table names etc.')
     parser.add_argument('--force', action='store_true', help='do not ask for confirmation')
     args = parser.parse_args()
 
+    for name in ['insert_size', 'concurrency']:
+        if getattr(args, name) < 1:
+            print(f"--{name.replace('_', '-')} should be at least 1")
+            sys.exit(-1)
+
     if 'REQUESTS_CA_BUNDLE' not in os.environ:
         os.environ['REQUESTS_CA_BUNDLE'] = '/etc/ssl/certs/ca-certificates.crt'
 
@@ -4,17 +4,36 @@
 This script helps to migrate off influxdb!
 
 Influxdb passwod should be set via INFLUX_PASSWORD env var.
+
+Optional, for faster parsing of large schemas:
+pip3 install orjson
 """
 
 import argparse
+import concurrent.futures
 import functools
-import json
 import os
 import pprint
 import sys
 
 import requests
 
+try:
+    # orjson parses bytes directly and is much faster on responses of many measurements.
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Reuse the connection to influxdb across queries.
+SESSION = requests.Session()
+# Clickhouse column type of each influxdb field type, and of tags.
+COLUMN_TYPES = {
+    'integer': 'Int64',
+    'float': 'Float32',
+    'string': 'String',
+    'tag': 'LowCardinality(String)',
+}
+
 
 def query_influxdb(args, params):
     """Run query on influxdb."""
@@ -23,11 +42,11 @@ def query_influxdb(args, params):
         print('INFLUX_PASSWORD env var has to be set!')
         sys.exit(1)
 
-    r = requests.get(f'{args.url}/query', auth=(args.user, password), params=params)
+    r = SESSION.get(f'{args.url}/query', auth=(args.user, password), params=params)
     if r.status_code != 200:
         sys.exit(-1)
 
-    data = json.loads(r.text)
+    data = json_loads(r.content)
     return data
 
 
@@ -41,12 +60,19 @@ def get_measurements(args):
     if args.verbose:
         pprint.pprint(measurements)
 
-    # Get fields from default retention.
-    queries = []
+    # Get fields from default retention, and tags. The two queries are independent, run them at once.
+    field_queries = []
+    tag_queries = []
     for m in measurements:
-        queries.append(f'SHOW FIELD KEYS FROM "{m}"')
+        field_queries.append(f'SHOW FIELD KEYS FROM "{m}"')
+        tag_queries.append(f'SHOW TAG KEYS FROM "{m}"')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        fields = executor.submit(query_influxdb, args, {'q': ';'.join(field_queries), 'db': args.db})
+        tags = executor.submit(query_influxdb, args, {'q': ';'.join(tag_queries), 'db': args.db})
+        data = fields.result()
+        tag_data = tags.result()
 
-    data = query_influxdb(args, params={'q': ';'.join(queries), 'db': args.db})
     mstagfields = {}
     for i in data['results']:
         # Empty measurement has no fields or a measurement exists only in non-default retention.
@@ -56,14 +82,8 @@ def get_measurements(args):
 
         mstagfields[i['series'][0]['name']] = {x[0]: x[1] for x in i['series'][0]['values']}
 
-    # Get tags.
-    queries = []
-    for m in mstagfields:
-        queries.append(f'SHOW TAG KEYS FROM "{m}"')
-
-    data = query_influxdb(args, params={'q': ';'.join(queries), 'db': args.db})
-    for i in data['results']:
-        if 'series' not in i:
+    for i in tag_data['results']:
+        if 'series' not in i or i['series'][0]['name'] not in mstagfields:
             continue
 
         mstagfields[i['series'][0]['name']].update({x[0]: 'tag' for x in i['series'][0]['values']})
@@ -86,19 +106,14 @@ def generate_schemas(args, mstagfields):
         primary_key = []
         for k, v in tagfields.items():
             k = sanitize_column_name(k)
-            if v == 'integer':
-                columns.append(f'`{k}` Int64')
-            elif v == 'float':
-                columns.append(f'`{k}` Float32')
-            elif v == 'string':
-                columns.append(f'`{k}` String')
-            elif v == 'tag':
-                columns.append(f'`{k}` LowCardinality(String)')
-                primary_key.append(f'`{k}`')
-            else:
+            if v not in COLUMN_TYPES:
                 print(f'Unknown type on {table}: {k} {v}')
                 sys.exit(-1)
 
+            columns.append(f'`{k}` {COLUMN_TYPES[v]}')
+            if v == 'tag':
+                primary_key.append(f'`{k}`')
+
         columns = ',\n                '.join(columns)
         columns = columns + ','
         primary_key.append('`time`')  # Must go last for CH performance reasons.